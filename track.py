@@ -1,12 +1,52 @@
+import argparse
+import atexit
+import functools
+import gzip
+import inspect
+import json
+import os
 import sys
+import threading
+import time
+import zlib
+from collections import OrderedDict
 from PyQt5.QtWidgets import (QApplication, QMainWindow, QWidget, QVBoxLayout, 
                              QHBoxLayout, QPushButton, QLabel, QFileDialog, QComboBox, 
                              QMessageBox, QLineEdit)
-from PyQt5.QtGui import QPixmap, QImage, QPainter, QPen, QCursor, QDoubleValidator
-from PyQt5.QtCore import Qt, QPoint, pyqtSignal
+from PyQt5.QtGui import (QPixmap, QImage, QImageReader, QImageIOHandler, QPainter, QPen, QDoubleValidator,
+                         QMouseEvent, QWheelEvent)
+from PyQt5.QtCore import Qt, QEvent, QObject, QPoint, QPointF, QRect, pyqtSignal
 import numpy as np
 
 
+# InteractionRecorder currently logging user actions, if any
+_active_recorder = None
+
+
+def recorded(method):
+    """
+    Log calls to a window action with the active InteractionRecorder. Only the
+    outermost recorded call is logged, since replaying it repeats the inner ones.
+    """
+    # Qt passes `checked` to slots connected directly to button clicks; drop it
+    n_args = len(inspect.signature(method).parameters) - 1
+
+    @functools.wraps(method)
+    def wrapper(self, *args):
+        args = args[:n_args]
+        recorder = _active_recorder
+        if recorder is None or recorder.depth:
+            return method(self, *args)
+        recorder.log_call(self, method.__name__, args)
+        recorder.depth += 1
+        try:
+            return method(self, *args)
+        finally:
+            recorder.depth -= 1
+            recorder.attach_new_windows(self)
+    return wrapper
+
+
 class ImageTrackingApp(QMainWindow):
     def __init__(self):
         super().__init__()
@@ -15,6 +55,11 @@ class ImageTrackingApp(QMainWindow):
         self.motor_axis_2 = None
         self.transformation_matrix = None
         self.origin = None
+        self.correspondences = []  # list of ((ref column, ref row), (feature column, feature row))
+        self.distortion_model = None
+        self.calibration_stats = None
+        self.prefetcher = ImagePrefetcher(capacity=12, max_bytes=512 << 20)
+        self.folder_browsers = {"left": ImageFolderBrowser(self.prefetcher), "right": ImageFolderBrowser(self.prefetcher)}
 
     def initUI(self):
         # Set window title
@@ -64,7 +109,15 @@ class ImageTrackingApp(QMainWindow):
 
         left_upload_btn = QPushButton("Upload Image")
         left_upload_btn.clicked.connect(lambda: self.upload_image("left"))
-        left_layout.addWidget(left_upload_btn)
+        left_previous_btn = QPushButton("< Previous")
+        left_previous_btn.clicked.connect(lambda: self.step_image("left", -1))
+        left_next_btn = QPushButton("Next >")
+        left_next_btn.clicked.connect(lambda: self.step_image("left", 1))
+        left_file_controls = QHBoxLayout()
+        left_file_controls.addWidget(left_previous_btn)
+        left_file_controls.addWidget(left_upload_btn)
+        left_file_controls.addWidget(left_next_btn)
+        left_layout.addLayout(left_file_controls)
 
         self.left_coord_label = QLabel("Coordinates: ")
         left_layout.addWidget(self.left_coord_label)
@@ -101,7 +154,15 @@ class ImageTrackingApp(QMainWindow):
 
         right_upload_btn = QPushButton("Upload Image")
         right_upload_btn.clicked.connect(lambda: self.upload_image("right"))
-        right_layout.addWidget(right_upload_btn)
+        right_previous_btn = QPushButton("< Previous")
+        right_previous_btn.clicked.connect(lambda: self.step_image("right", -1))
+        right_next_btn = QPushButton("Next >")
+        right_next_btn.clicked.connect(lambda: self.step_image("right", 1))
+        right_file_controls = QHBoxLayout()
+        right_file_controls.addWidget(right_previous_btn)
+        right_file_controls.addWidget(right_upload_btn)
+        right_file_controls.addWidget(right_next_btn)
+        right_layout.addLayout(right_file_controls)
 
         self.right_coord_label = QLabel("Coordinates: ")
         right_layout.addWidget(self.right_coord_label)
@@ -132,6 +193,34 @@ class ImageTrackingApp(QMainWindow):
         self.save_matrix_button.clicked.connect(self.handle_solve_transformation)
         main_layout.addWidget(self.save_matrix_button)
 
+        # Controls for collecting correspondences and fitting a nonlinear distortion model
+        distortion_controls = QHBoxLayout()
+
+        add_correspondence_button = QPushButton("Add Correspondence")
+        add_correspondence_button.clicked.connect(self.add_correspondence)
+        distortion_controls.addWidget(add_correspondence_button)
+
+        clear_correspondences_button = QPushButton("Clear Correspondences")
+        clear_correspondences_button.clicked.connect(self.clear_correspondences)
+        distortion_controls.addWidget(clear_correspondences_button)
+
+        self.correspondence_count_label = QLabel("Correspondences: 0")
+        distortion_controls.addWidget(self.correspondence_count_label)
+
+        self.distortion_dropdown = QComboBox()
+        self.distortion_dropdown.addItems(["polynomial", "thin-plate spline"])
+        distortion_controls.addWidget(self.distortion_dropdown)
+
+        fit_distortion_button = QPushButton("Fit Distortion Model")
+        fit_distortion_button.clicked.connect(self.handle_fit_distortion)
+        distortion_controls.addWidget(fit_distortion_button)
+
+        robust_calibration_button = QPushButton("Robust Calibration (RANSAC)")
+        robust_calibration_button.clicked.connect(self.handle_robust_calibration)
+        distortion_controls.addWidget(robust_calibration_button)
+
+        main_layout.addLayout(distortion_controls)
+
         # Add controls for motor displacement
         displacement_controls = QHBoxLayout()
 
@@ -193,13 +282,30 @@ class ImageTrackingApp(QMainWindow):
         )
 
         if file_name:
-            image = QImage(file_name)
-            pixmap = QPixmap.fromImage(image)
+            self.load_image(panel, file_name)
 
-            if panel == "left":
-                self.left_image_label.set_image(pixmap, image.size())
-            else:
-                self.right_image_label.set_image(pixmap, image.size())
+    @recorded
+    def load_image(self, panel, file_name):
+        image = self.prefetcher.get(file_name)
+        if image.isNull():
+            self.show_message(f"Cannot read image {file_name}")
+            return
+        pixmap = QPixmap.fromImage(image)
+        self.folder_browsers[panel].set_current(file_name)
+
+        if panel == "left":
+            self.left_image_label.set_image(pixmap, image.size())
+        else:
+            self.right_image_label.set_image(pixmap, image.size())
+
+    @recorded
+    def step_image(self, panel, offset):
+        """
+        Load the image `offset` files away in the folder of the panel's current image.
+        """
+        file_name = self.folder_browsers[panel].readable_neighbour(offset)
+        if file_name:
+            self.load_image(panel, file_name)
 
     def show_coordinates(self, pos, panel):
         if panel == "left":
@@ -214,6 +320,7 @@ class ImageTrackingApp(QMainWindow):
         else:
             coord_label.setText("Coordinates: None")
 
+    @recorded
     def set_point(self, panel):
         if panel == "left":
             label = self.left_image_label
@@ -247,6 +354,7 @@ class ImageTrackingApp(QMainWindow):
             points_text += f'<div style="color: {color};">{text}</div>'
         points_label.setText(points_text)
 
+    @recorded
     def handle_solve_transformation(self):
         """
         Handles solving the transformation matrix between the points.
@@ -278,6 +386,80 @@ class ImageTrackingApp(QMainWindow):
         except Exception as e:
             self.show_message(f"Error solving transformation: {e}")
 
+    @recorded
+    def add_correspondence(self):
+        """
+        Store the current left and right crosshair positions as a matching pair.
+        """
+        left_pos = self.left_image_label.crosshair_pos
+        right_pos = self.right_image_label.crosshair_pos
+        if not left_pos or not right_pos:
+            self.show_message("Click the same feature on both panels before adding a correspondence.")
+            return
+
+        self.correspondences.append(((left_pos.x(), left_pos.y()), (right_pos.x(), right_pos.y())))
+        self.correspondence_count_label.setText(f"Correspondences: {len(self.correspondences)}")
+
+    @recorded
+    def clear_correspondences(self):
+        self.correspondences = []
+        self.distortion_model = None
+        self.correspondence_count_label.setText("Correspondences: 0")
+
+    @recorded
+    def handle_fit_distortion(self):
+        """
+        Fits a nonlinear model mapping reference pixels to feature pixels
+        from the collected correspondences.
+        """
+        if not self.correspondences:
+            self.show_message("No correspondences collected. Use Add Correspondence first.")
+            return
+
+        ref_points = np.array([ref for ref, _ in self.correspondences], dtype=float)
+        feature_points = np.array([feature for _, feature in self.correspondences], dtype=float)
+        kind = "tps" if self.distortion_dropdown.currentText() == "thin-plate spline" else "polynomial"
+
+        try:
+            self.distortion_model = DistortionModel.fit(ref_points, feature_points, kind=kind)
+            residual = self.distortion_model.rms_residual(ref_points, feature_points)
+            self.show_message(f"Fitted {kind} distortion model from {len(ref_points)} correspondences.\n"
+                              f"RMS residual: {residual:.3f} pixels")
+        except Exception as e:
+            self.distortion_model = None
+            self.show_message(f"Error fitting distortion model: {e}")
+
+    @recorded
+    def handle_robust_calibration(self):
+        """
+        Solves the transformation matrix from all correspondences and panel markers,
+        rejecting mismatched pairs with RANSAC.
+        """
+        left_markers = self.left_image_label.get_marker_coordinates()
+        right_markers = self.right_image_label.get_marker_coordinates()
+        if not left_markers.get("origin"):
+            self.show_message("Left panel is missing the origin. Set it before calibrating.")
+            return
+
+        pairs = list(self.correspondences)
+        for key in ["origin", "axis 1", "axis 2"]:
+            if left_markers.get(key) and right_markers.get(key):
+                pairs.append((left_markers[key], right_markers[key]))
+
+        ref_points = np.array([ref for ref, _ in pairs], dtype=float).reshape(-1, 2)
+        feature_points = np.array([feature for _, feature in pairs], dtype=float).reshape(-1, 2)
+
+        try:
+            self.transformation_matrix, self.calibration_stats = solve_transformation_ransac(ref_points, feature_points)
+            self.origin = np.array(left_markers["origin"])
+            stats = self.calibration_stats
+            self.show_message(f"Transformation Matrix:\n{self.transformation_matrix}\n"
+                              f"Inliers: {stats['n_inliers']}/{stats['n_points']} ({stats['inlier_ratio']:.1%}), "
+                              f"RMS residual: {stats['rms_residual']:.3f} pixels\n"
+                              f"{stats['n_hypotheses']} hypotheses in {stats['elapsed_ms']:.1f} ms")
+        except Exception as e:
+            self.show_message(f"Error solving robust transformation: {e}")
+
     def handle_solve_displacement(self):
         """
         Handles solving the average displacement vector between points.
@@ -312,6 +494,7 @@ class ImageTrackingApp(QMainWindow):
         msg_box.exec_()
 
 
+    @recorded
     def save_displacement(self):
         """
         Save the displacement vector and motor displacement value
@@ -360,15 +543,24 @@ class ImageTrackingApp(QMainWindow):
             self.show_message(f"Error saving displacement: {e}")
 
 
+    @recorded
     def launch_interactive_map(self):
         """
         Launch the interactive map window.
         """
         if self.transformation_matrix is not None and self.motor_axis_1 is not None and self.motor_axis_2 is not None:
+            # Close the previous map so its prefetch thread and cache are released
+            if getattr(self, "interactive_map_window", None) is not None:
+                self.interactive_map_window.close()
             self.interactive_map_window = InteractiveMapWindow(self.origin, self.transformation_matrix, 
-                                                            self.motor_axis_1, self.motor_axis_2)
+                                                            self.motor_axis_1, self.motor_axis_2,
+                                                            distortion_model=self.distortion_model)
             self.interactive_map_window.show()
 
+    def closeEvent(self, event):
+        self.prefetcher.stop()
+        super().closeEvent(event)
+
 
 
 class ClickableLabel(QLabel):
@@ -417,8 +609,8 @@ class ClickableLabel(QLabel):
 
         # Scale the image based on the current zoom level
         scaled_pixmap = self.original_pixmap.scaled(
-            self.original_size.width() * self.current_scale,
-            self.original_size.height() * self.current_scale,
+            int(self.original_size.width() * self.current_scale),
+            int(self.original_size.height() * self.current_scale),
             Qt.KeepAspectRatio,
             Qt.SmoothTransformation,
         )
@@ -442,8 +634,8 @@ class ClickableLabel(QLabel):
             new_center_x = current_center_x / self.scale_factor[0]
             new_center_y = current_center_y / self.scale_factor[1]
             self.image_offset = QPoint(
-                self.width() // 2 - new_center_x,
-                self.height() // 2 - new_center_y,
+                int(self.width() // 2 - new_center_x),
+                int(self.height() // 2 - new_center_y),
             )
 
         self.update()
@@ -455,7 +647,7 @@ class ClickableLabel(QLabel):
             return  # Do not allow zoom if no image is uploaded
 
         # Check if the mouse is within the image boundaries
-        cursor_pos = self.mapFromGlobal(QCursor.pos())
+        cursor_pos = event.pos()
         if not (self.image_offset.x() <= cursor_pos.x() < self.image_offset.x() + self.pixmap().width() and
                 self.image_offset.y() <= cursor_pos.y() < self.image_offset.y() + self.pixmap().height()):
             return  # Do not zoom if the cursor is outside the image
@@ -526,7 +718,7 @@ class ClickableLabel(QLabel):
             # Update image offset and clamp within bounds
             new_offset_x = max(min_offset_x, min(max_offset_x, self.image_offset.x() + delta.x()))
             new_offset_y = max(min_offset_y, min(max_offset_y, self.image_offset.y() + delta.y()))
-            self.image_offset = QPoint(new_offset_x, new_offset_y)
+            self.image_offset = QPoint(int(new_offset_x), int(new_offset_y))
             self.update()
 
 
@@ -592,13 +784,29 @@ class ClickableLabel(QLabel):
 
 
 class InteractiveMapWindow(QMainWindow):
-    def __init__(self, origin, transformation_matrix, motor_axis_1, motor_axis_2):
+    # (width, height, MotorLookupGrid or Exception, queries per second) from the build thread
+    lookup_grid_ready = pyqtSignal(int, int, object, float)
+    # (tiles done, tiles total) and (export directory, streamed flag or Exception) from the export thread
+    export_progress = pyqtSignal(int, int)
+    export_finished = pyqtSignal(str, object)
+
+    def __init__(self, origin, transformation_matrix, motor_axis_1, motor_axis_2, distortion_model=None):
         super().__init__()
         self.initUI()
         self.origin = origin
         self.transformation_matrix = transformation_matrix
         self.motor_axis_1 = motor_axis_1
         self.motor_axis_2 = motor_axis_2
+        self.distortion_model = distortion_model
+        self.lookup_grid = None
+        self.lookup_grid_size = None  # image size the grid is built or being built for
+        self.lookup_grid_ready.connect(self.on_lookup_grid_ready)
+        self.export_progress.connect(self.on_export_progress)
+        self.export_finished.connect(self.on_export_finished)
+        self.image_path = None
+        self.annotations = []  # clicked points with their solved motor coordinates
+        self.prefetcher = ImagePrefetcher(capacity=6, max_bytes=256 << 20)
+        self.folder_browser = ImageFolderBrowser(self.prefetcher)
 
     def initUI(self):
         self.setWindowTitle("Interactive Map")
@@ -622,7 +830,7 @@ class InteractiveMapWindow(QMainWindow):
         # Image panel (ClickableLabel)
         self.image_label = ClickableLabel(self)
         self.image_label.setStyleSheet("background-color: #f0f0f0; border: 1px solid #ccc;")
-        self.image_label.setFixedSize(window_width * 0.8, window_height * 0.9)
+        self.image_label.setFixedSize(int(window_width * 0.8), int(window_height * 0.9))
         self.image_label.clicked.connect(self.update_coordinate_display)
         main_layout.addWidget(self.image_label)
 
@@ -634,6 +842,16 @@ class InteractiveMapWindow(QMainWindow):
         upload_button.clicked.connect(self.upload_image)
         right_panel.addWidget(upload_button)
 
+        # Step through the images in the current image's folder
+        previous_button = QPushButton("< Previous Image")
+        previous_button.clicked.connect(lambda: self.step_image(-1))
+        next_button = QPushButton("Next Image >")
+        next_button.clicked.connect(lambda: self.step_image(1))
+        file_controls = QHBoxLayout()
+        file_controls.addWidget(previous_button)
+        file_controls.addWidget(next_button)
+        right_panel.addLayout(file_controls)
+
         # Origin axis input fields
         axis_inputs_layout = QHBoxLayout()
 
@@ -674,6 +892,21 @@ class InteractiveMapWindow(QMainWindow):
         self.motor_axis_2_display.setStyleSheet("font-size: 16px; font-weight: bold;")
         right_panel.addWidget(self.motor_axis_2_display)
 
+        # Lookup grid statistics (only used with a distortion model)
+        self.lookup_grid_display = QLabel("Lookup Grid: None (linear calibration)")
+        self.lookup_grid_display.setAlignment(Qt.AlignLeft)
+        self.lookup_grid_display.setWordWrap(True)
+        right_panel.addWidget(self.lookup_grid_display)
+
+        # Export image tiles, calibration and annotations for downstream tools
+        self.export_button = QPushButton("Export Calibrated Map")
+        self.export_button.clicked.connect(self.export_map)
+        right_panel.addWidget(self.export_button)
+
+        self.export_status_display = QLabel("")
+        self.export_status_display.setAlignment(Qt.AlignLeft)
+        right_panel.addWidget(self.export_status_display)
+
 
         # Add right panel to main layout
         main_layout.addLayout(right_panel)
@@ -682,9 +915,72 @@ class InteractiveMapWindow(QMainWindow):
         options = QFileDialog.Options()
         file_path, _ = QFileDialog.getOpenFileName(self, "Upload Image", "", "Images (*.png *.jpg *.jpeg *.bmp *.gif)", options=options)
         if file_path:
-            pixmap = QPixmap(file_path)
-            image = QImage(file_path)
-            self.image_label.set_image(pixmap, image.size())  # Use set_image to initialize scale_factor
+            self.load_image(file_path)
+
+    @recorded
+    def load_image(self, file_path):
+        image = self.prefetcher.get(file_path)
+        if image.isNull():
+            self.show_message(f"Cannot read image {file_path}")
+            return
+        pixmap = QPixmap.fromImage(image)
+        self.folder_browser.set_current(file_path)
+        self.image_label.set_image(pixmap, image.size())  # Use set_image to initialize scale_factor
+        self.image_path = file_path
+        self.annotations = []
+        if self.distortion_model is not None:
+            self.build_lookup_grid(image.width(), image.height())
+
+    @recorded
+    def step_image(self, offset):
+        file_path = self.folder_browser.readable_neighbour(offset)
+        if file_path:
+            self.load_image(file_path)
+
+    def closeEvent(self, event):
+        self.prefetcher.stop()
+        super().closeEvent(event)
+
+    def build_lookup_grid(self, width, height):
+        """
+        Precompute the pixel -> motor displacement grid for the distortion model on a
+        background thread. The grid depends only on the image size, so images of the
+        same size reuse it. Clicks evaluate the model directly until it is ready.
+        """
+        if self.lookup_grid_size == (width, height):
+            return
+
+        self.lookup_grid = None
+        self.lookup_grid_size = (width, height)
+        self.lookup_grid_display.setText(f"Lookup Grid: building for {width} x {height} image...")
+        threading.Thread(target=self._build_lookup_grid, args=(width, height), daemon=True).start()
+
+    def _build_lookup_grid(self, width, height):
+        try:
+            grid = MotorLookupGrid.build(self.distortion_model, self.origin,
+                                         self.motor_axis_1, self.motor_axis_2, width, height)
+            rate = grid.measure_throughput()
+        except Exception as e:
+            self.lookup_grid_ready.emit(width, height, e, 0.0)
+            return
+        self.lookup_grid_ready.emit(width, height, grid, rate)
+
+    def on_lookup_grid_ready(self, width, height, grid, rate):
+        if self.lookup_grid_size != (width, height):
+            return  # a different image size was loaded while building
+
+        if isinstance(grid, Exception):
+            self.lookup_grid_size = None
+            self.lookup_grid_display.setText("Lookup Grid: None")
+            self.show_message(f"Error building lookup grid: {grid}")
+            return
+
+        self.lookup_grid = grid
+        grid_height, grid_width = grid.shape
+        self.lookup_grid_display.setText(
+            f"Lookup Grid: {grid_width} x {grid_height} nodes, {grid.nbytes / 2**20:.1f} MB, "
+            f"built in {grid.build_seconds * 1e3:.1f} ms, {rate / 1e6:.1f} M queries/s"
+        )
 
     def update_coordinate_display(self):
         if self.image_label.crosshair_pos:
@@ -693,12 +989,14 @@ class InteractiveMapWindow(QMainWindow):
             motor_axis_1, motor_axis_2 = self.solve_motor_values()
             self.motor_axis_1_display.setText(f"Motor Axis 1: {motor_axis_1:.2f}")
             self.motor_axis_2_display.setText(f"Motor Axis 2: {motor_axis_2:.2f}")
+            self.annotations.append({"pixel": [int(x), int(y)], "motor": [float(motor_axis_1), float(motor_axis_2)]})
 
         else:
             self.coordinate_display.setText("Coordinates: None")
             self.motor_axis_1_display.setText("Motor Axis 1: None")
             self.motor_axis_2_display.setText("Motor Axis 2: None")
 
+    @recorded
     def update_origin_motor_coordinates(self):
         """
         Update the origin motor coordinates from the text fields.
@@ -711,8 +1009,94 @@ class InteractiveMapWindow(QMainWindow):
             self.show_message("Invalid input for origin coordinates.")
 
 
+    def export_map(self):
+        """
+        Export the uploaded image as a tiled pyramid together with the calibration and annotations.
+        """
+        if not self.image_path:
+            self.show_message("Upload an image before exporting.")
+            return
+
+        needed = whole_decode_bytes(self.image_path)
+        if needed > MAX_WHOLE_DECODE_BYTES:
+            self.show_message(f"This image format cannot be read in bands and would need {needed / 2**20:.0f} MB "
+                              f"to export, over the {MAX_WHOLE_DECODE_BYTES / 2**20:.0f} MB limit. "
+                              f"Convert it to JPEG to export it.")
+            return
+
+        default_path = os.path.splitext(self.image_path)[0] + ".dtmap"
+        export_dir, _ = QFileDialog.getSaveFileName(self, "Export Calibrated Map", default_path, "Calibrated Map (*.dtmap)")
+        if not export_dir:
+            return
+
+        # Snapshot everything the export needs; the window stays usable while it runs
+        size = self.image_label.original_size
+        args = (self.image_path, export_dir, self.calibration_dict(), {"points": list(self.annotations)},
+                self.lookup_grid, size.width(), size.height())
+        self.export_button.setEnabled(False)
+        if needed:
+            self.export_status_display.setText(f"Exporting (decoding the whole image, about {needed / 2**20:.0f} MB)...")
+        else:
+            self.export_status_display.setText("Exporting...")
+        threading.Thread(target=self._export_map, args=args, daemon=True).start()
+
+    def _export_map(self, image_path, export_dir, calibration, annotations, lookup_grid, width, height):
+        try:
+            # The grid may still be building in the background; the export must include it
+            if self.distortion_model is not None and lookup_grid is None:
+                lookup_grid = MotorLookupGrid.build(self.distortion_model, self.origin, self.motor_axis_1,
+                                                    self.motor_axis_2, width, height)
+            streamed = export_calibrated_map(image_path, export_dir, calibration, annotations,
+                                             lookup_grid=lookup_grid, progress=self.export_progress.emit)
+        except Exception as e:
+            self.export_finished.emit(export_dir, e)
+            return
+        self.export_finished.emit(export_dir, streamed)
+
+    def on_export_progress(self, done, total):
+        self.export_status_display.setText(f"Exporting tiles: {done}/{total}")
+
+    def on_export_finished(self, export_dir, result):
+        self.export_button.setEnabled(True)
+        if isinstance(result, Exception):
+            self.export_status_display.setText("")
+            self.show_message(f"Error exporting map: {result}")
+        elif result:
+            self.export_status_display.setText(f"Exported to {export_dir}")
+        else:
+            self.export_status_display.setText(
+                f"Exported to {export_dir}\n(this format cannot be read in bands; the whole image was decoded in memory)")
+
+    def calibration_dict(self):
+        """
+        JSON-serializable description of the current pixel -> motor calibration.
+        """
+        return {
+            # "linear": motor values follow transformation_matrix.
+            # "distortion": motor values follow distortion_model (reference pixel ->
+            # feature pixel), sampled in lookup_grid; transformation_matrix is unused.
+            "active_model": "linear" if self.distortion_model is None else "distortion",
+            "distortion_model": self.distortion_model.to_dict() if self.distortion_model is not None else None,
+            "origin_pixel": np.asarray(self.origin).tolist(),
+            "transformation_matrix": np.asarray(self.transformation_matrix).tolist(),
+            "motor_axis_1": {"image_displacement": np.asarray(self.motor_axis_1[0]).tolist(),
+                             "motor_displacement": float(self.motor_axis_1[1])},
+            "motor_axis_2": {"image_displacement": np.asarray(self.motor_axis_2[0]).tolist(),
+                             "motor_displacement": float(self.motor_axis_2[1])},
+            "origin_motor_coordinate": ([self.origin_axis_1, self.origin_axis_2]
+                                        if hasattr(self, 'origin_axis_1') and hasattr(self, 'origin_axis_2') else None),
+        }
+
     def solve_motor_values(self):
         x, y = self.image_label.crosshair_pos.x(), self.image_label.crosshair_pos.y()
+        if self.distortion_model is not None:
+            if self.lookup_grid is not None:
+                motor_axis_1_displacement, motor_axis_2_displacement = self.lookup_grid.lookup_point(x, y)
+            else:
+                motor_axis_1_displacement, motor_axis_2_displacement = motor_displacements(
+                    self.distortion_model, self.origin, self.motor_axis_1, self.motor_axis_2, np.array([[x, y]]))[0]
+            return self.origin_axis_1 + motor_axis_1_displacement, self.origin_axis_2 + motor_axis_2_displacement
+
         v = np.array([x, y]) - self.origin   # image vector
 
         motor_axis_1_displacement = self.motor_axis_1[1]
@@ -756,13 +1140,928 @@ def solve_image_displacement(p1, p2, p3, p4, p5, p6):
     return np.round((v1 + v2 + v3) / 3).astype(int)
 
 
+# refit affine params (feature = [x, y, 1] @ params) by least squares on their
+# inliers until the inlier set stops changing; returns params and inlier mask
+def _refine_affine(design, feature_points, params, threshold):
+    inliers = None
+    for _ in range(5):
+        residuals = np.sum((design @ params - feature_points) ** 2, axis=1)
+        new_inliers = residuals < threshold ** 2
+        if new_inliers.sum() < 3 or (inliers is not None and np.array_equal(new_inliers, inliers)):
+            break
+        inliers = new_inliers
+        params = np.linalg.lstsq(design[inliers], feature_points[inliers], rcond=None)[0]
+    if inliers is None:
+        inliers = new_inliers
+    return params, inliers
+
+
+def solve_transformation_ransac(ref_points, feature_points, n_hypotheses=2000, threshold=3.0, seed=None):
+    """
+    Robustly fit feature = M @ ref + offset from (N, 2) arrays of (column, row)
+    correspondences. All minimal three-point hypotheses are solved and scored
+    against every correspondence in batched NumPy operations (MSAC scoring),
+    then the best one is refined by least squares on its inliers.
+
+    Returns the 2x2 transformation matrix M, in the same convention as
+    solve_transformation, and a dict of inlier statistics.
+    """
+    start = time.perf_counter()
+    ref_points = np.asarray(ref_points, dtype=float)
+    feature_points = np.asarray(feature_points, dtype=float)
+    n = len(ref_points)
+    if ref_points.shape != (n, 2) or feature_points.shape != (n, 2):
+        raise ValueError("Correspondences must be two matching (N, 2) arrays of points.")
+    if n < 3:
+        raise ValueError(f"At least 3 correspondences are needed, got {n}.")
+
+    # Normalize reference points for conditioning and center feature points;
+    # residuals stay in feature pixels
+    center = ref_points.mean(axis=0)
+    scale = max(float(np.abs(ref_points - center).max()), 1.0)
+    design = np.column_stack(((ref_points - center) / scale, np.ones(n)))
+    feature_center = feature_points.mean(axis=0)
+    targets = feature_points - feature_center
+
+    # Minimal samples, dropping those with repeated or collinear points
+    rng = np.random.default_rng(seed)
+    samples = rng.integers(0, n, size=(n_hypotheses, 3))
+    sample_design = design[samples]
+    valid = np.abs(np.linalg.det(sample_design)) > 1e-6
+    if not valid.any():
+        raise ValueError("Correspondences are degenerate. Spread points over the field.")
+    hypotheses = np.linalg.solve(sample_design[valid], targets[samples[valid]])  # (K, 3, 2)
+
+    # Score hypotheses in chunks of (N, K) residuals. Each chunk is predicted by
+    # one (N, 3) @ (3, 2K) product in float32, which is ample for ranking
+    design32 = design.astype(np.float32)
+    targets32 = targets.astype(np.float32)
+    chunk = max(1, (1 << 20) // n)
+    scores = np.empty(len(hypotheses))
+    for first in range(0, len(hypotheses), chunk):
+        params = hypotheses[first:first + chunk].astype(np.float32)
+        k = len(params)
+        predicted = design32 @ np.concatenate((params[:, :, 0].T, params[:, :, 1].T), axis=1)
+        dx, dy = predicted[:, :k], predicted[:, k:]
+        dx -= targets32[:, :1]
+        dy -= targets32[:, 1:]
+        dx *= dx
+        dy *= dy
+        dx += dy
+        np.minimum(dx, threshold ** 2, out=dx)
+        scores[first:first + chunk] = dx.sum(axis=0)
+
+    params, inliers = _refine_affine(design, targets, hypotheses[np.argmin(scores)], threshold)
+    residuals = np.sqrt(np.sum((design @ params - targets) ** 2, axis=1))
+
+    M = params[:2].T / scale
+    offset = params[2] + feature_center - M @ center
+    stats = {
+        "inliers": inliers,
+        "n_inliers": int(inliers.sum()),
+        "n_points": n,
+        "inlier_ratio": float(inliers.mean()),
+        "rms_residual": float(np.sqrt(np.mean(residuals[inliers] ** 2))) if inliers.any() else float("nan"),
+        "offset": offset,
+        "n_hypotheses": len(hypotheses),
+        "elapsed_ms": (time.perf_counter() - start) * 1e3,
+    }
+    return M, stats
+
+# exponents (i, j) of the monomials x^i y^j with i + j <= degree
+def _monomial_exponents(degree):
+    return [(i, total - i) for total in range(degree + 1) for i in range(total, -1, -1)]
+
+def _monomials(points, exponents):
+    return np.stack([points[:, 0] ** i * points[:, 1] ** j for i, j in exponents], axis=1)
+
+# thin-plate spline radial basis r^2 log(r) between every row of a and every row of b
+def _tps_kernel(a, b):
+    d2 = np.maximum(np.sum(a ** 2, axis=1)[:, None] + np.sum(b ** 2, axis=1)[None, :] - 2 * a @ b.T, 0.0)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        return np.where(d2 > 0, 0.5 * d2 * np.log(d2), 0.0)
+
+
+class DistortionModel:
+    """
+    Nonlinear map from reference image pixels to feature image pixels,
+    fitted from many (column, row) correspondences. `kind` is either
+    "polynomial" (least squares over monomials up to `degree`) or "tps"
+    (thin-plate spline through the correspondences).
+    """
+
+    # upper bound on temporary float64 values created per evaluation chunk
+    CHUNK_VALUES = 1 << 22
+
+    def __init__(self, kind, center, scale, coefficients, exponents=None, control_points=None):
+        self.kind = kind
+        self.center = center
+        self.scale = scale
+        self.coefficients = coefficients
+        self.exponents = exponents
+        self.control_points = control_points
+
+    @classmethod
+    def fit(cls, ref_points, feature_points, kind="polynomial", degree=3, smoothing=0.0):
+        ref_points = np.asarray(ref_points, dtype=float)
+        feature_points = np.asarray(feature_points, dtype=float)
+        if ref_points.ndim != 2 or ref_points.shape[1] != 2 or ref_points.shape != feature_points.shape:
+            raise ValueError("Correspondences must be two matching (N, 2) arrays of points.")
+
+        # Normalize coordinates so the fit is well conditioned for large images
+        center = ref_points.mean(axis=0)
+        scale = max(float(np.abs(ref_points - center).max()), 1.0)
+        points = (ref_points - center) / scale
+        n = len(points)
+
+        if kind == "polynomial":
+            exponents = _monomial_exponents(degree)
+            if n < len(exponents):
+                raise ValueError(f"A degree {degree} polynomial needs at least {len(exponents)} correspondences, got {n}.")
+            coefficients, _, rank, _ = np.linalg.lstsq(_monomials(points, exponents), feature_points, rcond=None)
+            if rank < len(exponents):
+                raise ValueError("Correspondences are degenerate for a polynomial fit. Spread points over the field.")
+            return cls(kind, center, scale, coefficients, exponents=exponents)
+
+        if kind == "tps":
+            if n < 3:
+                raise ValueError(f"A thin-plate spline needs at least 3 correspondences, got {n}.")
+            affine = np.column_stack((np.ones(n), points))
+            system = np.zeros((n + 3, n + 3))
+            system[:n, :n] = _tps_kernel(points, points) + smoothing * np.eye(n)
+            system[:n, n:] = affine
+            system[n:, :n] = affine.T
+            rhs = np.vstack((feature_points, np.zeros((3, 2))))
+            coefficients = np.linalg.solve(system, rhs)
+            return cls(kind, center, scale, coefficients, control_points=points)
+
+        raise ValueError(f"Unknown distortion model: {kind}")
+
+    def __call__(self, points):
+        """
+        Map an (..., 2) array of reference (column, row) pixels to feature pixels.
+        """
+        points = np.asarray(points, dtype=float)
+        flat = (points.reshape(-1, 2) - self.center) / self.scale
+        out = np.empty_like(flat)
+
+        if self.kind == "polynomial":
+            terms = len(self.exponents)
+        else:
+            terms = len(self.control_points) + 3
+        chunk = max(1, self.CHUNK_VALUES // terms)
+
+        for start in range(0, len(flat), chunk):
+            part = flat[start:start + chunk]
+            if self.kind == "polynomial":
+                out[start:start + chunk] = _monomials(part, self.exponents) @ self.coefficients
+            else:
+                n = len(self.control_points)
+                out[start:start + chunk] = (_tps_kernel(part, self.control_points) @ self.coefficients[:n]
+                                            + self.coefficients[n] + part @ self.coefficients[n + 1:])
+        return out.reshape(points.shape)
+
+    def rms_residual(self, ref_points, feature_points):
+        residuals = self(ref_points) - np.asarray(feature_points, dtype=float)
+        return float(np.sqrt(np.mean(np.sum(residuals ** 2, axis=1))))
+
+    def to_dict(self):
+        """
+        JSON-serializable parameters. Points are normalized as (p - center) / scale
+        before applying the coefficients.
+        """
+        return {
+            "kind": self.kind,
+            "center": np.asarray(self.center).tolist(),
+            "scale": float(self.scale),
+            "coefficients": np.asarray(self.coefficients).tolist(),
+            "exponents": [list(e) for e in self.exponents] if self.exponents is not None else None,
+            "control_points": np.asarray(self.control_points).tolist() if self.control_points is not None else None,
+        }
+
+    @classmethod
+    def from_dict(cls, data):
+        return cls(
+            data["kind"],
+            np.array(data["center"], dtype=float),
+            data["scale"],
+            np.array(data["coefficients"], dtype=float),
+            exponents=[tuple(e) for e in data["exponents"]] if data["exponents"] is not None else None,
+            control_points=np.array(data["control_points"], dtype=float) if data["control_points"] is not None else None,
+        )
+
+
+def motor_displacements(model, origin, motor_axis_1, motor_axis_2, points):
+    """
+    Motor displacements from the origin for an (..., 2) array of reference pixels
+    under a DistortionModel. Same chain as the linear path: feature displacement
+    -> image axes -> motor units.
+    """
+    u = model(points) - model(np.asarray(origin, dtype=float))
+    B = np.column_stack((motor_axis_1[0], motor_axis_2[0])).astype(float)
+    c = u @ np.linalg.inv(B).T
+    return c * -np.array([motor_axis_1[1], motor_axis_2[1]], dtype=float)
+
+
+class MotorLookupGrid:
+    """
+    Motor displacements sampled every `step` pixels over an image. Built once
+    from a DistortionModel, after which a pixel -> motor query is a bilinear
+    interpolation between the four surrounding grid nodes.
+    """
+
+    def __init__(self, values, step, width, height, build_seconds=0.0):
+        self.values = values  # (grid rows, grid columns, 2) motor displacements
+        self.step = step
+        self.width = width
+        self.height = height
+        self.build_seconds = build_seconds
+        self._max_x = values.shape[1] - 1
+        self._max_y = values.shape[0] - 1
+
+    @classmethod
+    def build(cls, model, origin, motor_axis_1, motor_axis_2, width, height, step=4):
+        start = time.perf_counter()
+
+        # Grid nodes cover the whole image, with at least two nodes per axis
+        columns = step * np.arange(max(2, int(np.ceil((width - 1) / step)) + 1), dtype=float)
+        rows = step * np.arange(max(2, int(np.ceil((height - 1) / step)) + 1), dtype=float)
+        nodes = np.stack(np.meshgrid(columns, rows), axis=-1)
+        values = np.ascontiguousarray(motor_displacements(model, origin, motor_axis_1, motor_axis_2, nodes))
+
+        return cls(values, step, width, height, build_seconds=time.perf_counter() - start)
+
+    @property
+    def shape(self):
+        return self.values.shape[:2]
+
+    @property
+    def nbytes(self):
+        return self.values.nbytes
+
+    def lookup(self, xs, ys):
+        """
+        Vectorized bilinear lookup. Returns an (..., 2) array of motor displacements.
+        """
+        gx = np.clip(np.asarray(xs, dtype=float) / self.step, 0, self._max_x)
+        gy = np.clip(np.asarray(ys, dtype=float) / self.step, 0, self._max_y)
+        i = np.minimum(gx.astype(np.intp), self._max_x - 1)
+        j = np.minimum(gy.astype(np.intp), self._max_y - 1)
+        fx = (gx - i)[..., None]
+        fy = (gy - j)[..., None]
+
+        v = self.values
+        top = v[j, i] * (1 - fx) + v[j, i + 1] * fx
+        bottom = v[j + 1, i] * (1 - fx) + v[j + 1, i + 1] * fx
+        return top * (1 - fy) + bottom * fy
+
+    def lookup_point(self, x, y):
+        """
+        Scalar lookup for a single click, avoiding array setup overhead.
+        """
+        gx = min(max(x / self.step, 0.0), self._max_x)
+        gy = min(max(y / self.step, 0.0), self._max_y)
+        i = min(int(gx), self._max_x - 1)
+        j = min(int(gy), self._max_y - 1)
+        fx = gx - i
+        fy = gy - j
+
+        cell = self.values[j:j + 2, i:i + 2]
+        m1, m2 = ((cell[0, 0] * (1 - fx) + cell[0, 1] * fx) * (1 - fy)
+                  + (cell[1, 0] * (1 - fx) + cell[1, 1] * fx) * fy)
+        return float(m1), float(m2)
+
+    def measure_throughput(self, n=100000):
+        """
+        Returns vectorized lookups per second over random points in the image.
+        """
+        rng = np.random.default_rng(0)
+        xs = rng.uniform(0, self.width, n)
+        ys = rng.uniform(0, self.height, n)
+        start = time.perf_counter()
+        self.lookup(xs, ys)
+        return n / max(time.perf_counter() - start, 1e-9)
+
+
+# copy a QImage into an (rows, columns, 3) uint8 array
+def _qimage_to_array(image):
+    image = image.convertToFormat(QImage.Format_RGB888)
+    ptr = image.constBits()
+    ptr.setsize(image.sizeInBytes())
+    rows = np.frombuffer(ptr, dtype=np.uint8).reshape(image.height(), image.bytesPerLine())
+    return rows[:, :image.width() * 3].reshape(image.height(), image.width(), 3).copy()
+
+
+# halve an (rows, columns, 3) uint8 block by averaging 2x2 pixels, repeating
+# the last row/column of odd-sized blocks
+def _downsample_half(block):
+    if block.shape[0] % 2:
+        block = np.concatenate((block, block[-1:]), axis=0)
+    if block.shape[1] % 2:
+        block = np.concatenate((block, block[:, -1:]), axis=1)
+    rows, columns = block.shape[0] // 2, block.shape[1] // 2
+    summed = block.reshape(rows, 2, columns, 2, -1).sum(axis=(1, 3), dtype=np.uint16)
+    return ((summed + 2) // 4).astype(np.uint8)
+
+
+# decoded-image bytes above which formats that cannot be read in bands are refused
+MAX_WHOLE_DECODE_BYTES = 1 << 30
+
+
+def whole_decode_bytes(image_path):
+    """
+    Bytes needed to decode `image_path` whole, or 0 if its reader can clip and
+    the export can read it in bands.
+    """
+    reader = QImageReader(image_path)
+    if reader.supportsOption(QImageIOHandler.ClipRect):
+        return 0
+    size = reader.size()
+    return max(size.width(), 0) * max(size.height(), 0) * 4
+
+
+def export_calibrated_map(image_path, export_dir, calibration, annotations, lookup_grid=None,
+                          tile_size=256, band_bytes=1 << 26, max_whole_decode_bytes=MAX_WHOLE_DECODE_BYTES,
+                          progress=None):
+    """
+    Write an image and its calibration as a directory other tools can random-read:
+
+        index.json                      levels, tile layout and file names
+        calibration.json                origin, matrices and motor axes
+        lookup_grid.npy                 dense motor displacement grid (if any), np.load(mmap_mode="r")
+        annotations.json                clicked points and their motor coordinates
+        tiles/<level>/<row>_<col>.npz   compressed "pixels" array, (rows, columns, 3) uint8
+
+    Level k is downsampled by 2**k, down to the first level that fits in one tile.
+    Level 0 is read in full-width bands of whole tile rows, at most about
+    `band_bytes` each, with QImageReader clip rects; every coarser level is built
+    from the tiles of the level below. Formats whose reader cannot clip (PNG,
+    BMP, GIF) are decoded whole once, so only clip-capable formats such as JPEG
+    export in bounded memory; such images needing more than
+    `max_whole_decode_bytes` are refused before decoding. index.json is written last, so an interrupted
+    export is recognisable by its absence.
+
+    Returns True if the image was read in bounded bands, False if it had to be
+    decoded whole.
+    """
+    reader = QImageReader(image_path)
+    size = reader.size()
+    if not size.isValid():
+        raise ValueError(f"Cannot read image size of {image_path}: {reader.errorString()}")
+    width, height = size.width(), size.height()
+    streaming = reader.supportsOption(QImageIOHandler.ClipRect)
+    if not streaming and width * height * 4 > max_whole_decode_bytes:
+        raise ValueError(f"{os.path.basename(image_path)} cannot be read in bands and would need "
+                         f"{width * height * 4 / 2**20:.0f} MB decoded whole, over the "
+                         f"{max_whole_decode_bytes / 2**20:.0f} MB limit. Convert it to JPEG to export it.")
+    source = None if streaming else QImage(image_path)
+    if source is not None and source.isNull():
+        raise ValueError(f"Cannot decode {image_path}")
+
+    levels = []
+    downsample = 1
+    while True:
+        level_width = -(-width // downsample)
+        level_height = -(-height // downsample)
+        levels.append({
+            "level": len(levels),
+            "downsample": downsample,
+            "width": level_width,
+            "height": level_height,
+            "rows": -(-level_height // tile_size),
+            "columns": -(-level_width // tile_size),
+        })
+        if level_width <= tile_size and level_height <= tile_size:
+            break
+        downsample *= 2
+
+    os.makedirs(export_dir, exist_ok=True)
+    total = sum(level["rows"] * level["columns"] for level in levels)
+    done = 0
+
+    def tile_path(level, row, column):
+        return os.path.join(export_dir, "tiles", str(level), f"{row}_{column}.npz")
+
+    def save_tile(level, row, column, pixels):
+        nonlocal done
+        np.savez_compressed(tile_path(level, row, column), pixels=pixels)
+        done += 1
+        if progress is not None:
+            progress(done, total)
+
+    for level in levels:
+        os.makedirs(os.path.join(export_dir, "tiles", str(level["level"])), exist_ok=True)
+
+    # Level 0: each band is decoded once and split into tiles. Readers that clip
+    # still decode the scanlines above the band, so bands are kept as tall as
+    # band_bytes allows to limit how often that happens
+    band_tile_rows = max(1, band_bytes // max(1, width * 4 * tile_size))
+    for first_row in range(0, levels[0]["rows"], band_tile_rows):
+        top = first_row * tile_size
+        band_height = min(band_tile_rows * tile_size, height - top)
+        if source is not None:
+            band = source.copy(0, top, width, band_height)
+        else:
+            band_reader = QImageReader(image_path)
+            band_reader.setClipRect(QRect(0, top, width, band_height))
+            band = band_reader.read()
+            if band.isNull():
+                raise ValueError(f"Cannot decode rows {top}-{top + band_height} of {image_path}: "
+                                 f"{band_reader.errorString()}")
+        pixels = _qimage_to_array(band)
+        band = None
+        for row in range(first_row, min(first_row + band_tile_rows, levels[0]["rows"])):
+            y = (row - first_row) * tile_size
+            for column in range(levels[0]["columns"]):
+                x = column * tile_size
+                save_tile(0, row, column, pixels[y:y + tile_size, x:x + tile_size])
+        pixels = None
+    source = None
+
+    # Coarser levels: each tile halves the (up to) 2x2 block of tiles below it
+    for below, level in zip(levels, levels[1:]):
+        for row in range(level["rows"]):
+            for column in range(level["columns"]):
+                children = [[np.load(tile_path(below["level"], child_row, child_column))["pixels"]
+                             for child_column in range(2 * column, min(2 * column + 2, below["columns"]))]
+                            for child_row in range(2 * row, min(2 * row + 2, below["rows"]))]
+                block = np.concatenate([np.concatenate(tiles, axis=1) for tiles in children], axis=0)
+                save_tile(level["level"], row, column, _downsample_half(block))
+
+    calibration = dict(calibration)
+    if lookup_grid is not None:
+        np.save(os.path.join(export_dir, "lookup_grid.npy"), lookup_grid.values)
+        calibration["lookup_grid"] = {"file": "lookup_grid.npy", "step": lookup_grid.step,
+                                      "layout": "(grid row, grid column, motor axis) motor displacement"}
+    with open(os.path.join(export_dir, "calibration.json"), "w") as f:
+        json.dump(calibration, f, indent=2)
+    with open(os.path.join(export_dir, "annotations.json"), "w") as f:
+        json.dump(annotations, f, indent=2)
+
+    index = {
+        "format": "dtmap",
+        "version": 1,
+        "source": os.path.basename(image_path),
+        "width": width,
+        "height": height,
+        "channels": 3,
+        "dtype": "uint8",
+        "coordinates": "(column, row) pixels of level 0",
+        "tile_size": tile_size,
+        "tile_path": "tiles/{level}/{row}_{column}.npz",
+        "levels": levels,
+        "calibration": "calibration.json",
+        "annotations": "annotations.json",
+    }
+    with open(os.path.join(export_dir, "index.json"), "w") as f:
+        json.dump(index, f, indent=2)
+    return streaming
+
+
+
+
+IMAGE_EXTENSIONS = (".png", ".jpg", ".jpeg", ".bmp", ".gif")
+
+
+class ImagePrefetcher:
+    """
+    Decodes images on a background thread into a least-recently-used cache of
+    QImages bounded by `max_bytes` of decoded pixels and, secondarily, by
+    `capacity` images. get() returns a cached image immediately, waits for one
+    that is being decoded, and otherwise decodes it on the calling thread.
+    """
+
+    def __init__(self, capacity=8, max_bytes=256 << 20):
+        self.capacity = capacity
+        self.max_bytes = max_bytes
+        self.cache = OrderedDict()
+        self.cache_bytes = 0
+        self.pending = OrderedDict()  # owner -> paths to decode, most wanted first
+        self.wanted = {}  # owner -> all paths last requested for prefetch
+        self.decoding = None
+        self.running = True
+        self.condition = threading.Condition()
+        self.thread = threading.Thread(target=self._run, name="ImagePrefetcher", daemon=True)
+        self.thread.start()
+
+    def prefetch(self, paths, owner=None):
+        """
+        Replace `owner`'s queue of images to decode ahead of time with `paths`.
+        Queues of different owners (e.g. the two panels) are served in turn.
+        """
+        with self.condition:
+            self.wanted[owner] = set(paths)
+            self.pending[owner] = [path for path in paths
+                                   if path not in self.cache and path != self.decoding][:self.capacity]
+            self.condition.notify()
+
+    def get(self, path):
+        path = os.path.abspath(path)
+        with self.condition:
+            while self.decoding == path:
+                self.condition.wait()
+            image = self.cache.get(path)
+            if image is not None:
+                self.cache.move_to_end(path)
+                return image
+            for paths in self.pending.values():
+                if path in paths:
+                    paths.remove(path)
+
+        image = QImage(path)
+        self._store(path, image)
+        return image
+
+    def is_cached(self, path):
+        with self.condition:
+            return os.path.abspath(path) in self.cache
+
+    def discard(self, path):
+        """
+        Drop `path` from the cache and queues, waiting out a decode in progress.
+        """
+        path = os.path.abspath(path)
+        with self.condition:
+            while self.decoding == path:
+                self.condition.wait()
+            for paths in self.pending.values():
+                if path in paths:
+                    paths.remove(path)
+            image = self.cache.pop(path, None)
+            if image is not None:
+                self.cache_bytes -= image.sizeInBytes()
+
+    def stop(self):
+        with self.condition:
+            self.running = False
+            self.pending.clear()
+            self.cache.clear()
+            self.cache_bytes = 0
+            self.condition.notify()
+
+    def _store(self, path, image, prefetched=False):
+        size = image.sizeInBytes()
+        if image.isNull() or size > self.max_bytes:
+            return
+        with self.condition:
+            old = self.cache.pop(path, None)
+            if old is not None:
+                self.cache_bytes -= old.sizeInBytes()
+
+            def full():
+                return len(self.cache) >= self.capacity or self.cache_bytes + size > self.max_bytes
+
+            # Evict least recently used images that are not queued neighbours first. A
+            # prefetch never evicts other neighbours; it is dropped instead
+            wanted = set().union(*self.wanted.values())
+            victims = [p for p in self.cache if p not in wanted]
+            if not prefetched:
+                victims += [p for p in self.cache if p in wanted]
+            for victim in victims:
+                if not full():
+                    break
+                self.cache_bytes -= self.cache.pop(victim).sizeInBytes()
+            if full():
+                return
+
+            self.cache[path] = image
+            self.cache_bytes += size
+
+    def _run(self):
+        while True:
+            with self.condition:
+                while self.running and not any(self.pending.values()):
+                    self.condition.wait()
+                if not self.running:
+                    return
+                # take from the first non-empty queue, then move its owner to the back
+                owner = next(owner for owner, paths in self.pending.items() if paths)
+                self.decoding = self.pending[owner].pop(0)
+                self.pending.move_to_end(owner)
+
+            # QImage (unlike QPixmap) may be decoded outside the GUI thread
+            image = QImage(self.decoding)
+            self._store(self.decoding, image, prefetched=True)
+            with self.condition:
+                self.decoding = None
+                self.condition.notify_all()
+
+
+class ImageFolderBrowser:
+    """
+    Steps through the image files in the folder of the current image and keeps
+    the `radius` images on either side of it prefetched.
+    """
+
+    def __init__(self, prefetcher, radius=2):
+        self.prefetcher = prefetcher
+        self.radius = radius
+        self.files = []
+        self.index = None
+
+    def set_current(self, path):
+        path = os.path.abspath(path)
+        folder = os.path.dirname(path)
+        self.files = sorted(
+            (os.path.join(folder, name) for name in os.listdir(folder) if name.lower().endswith(IMAGE_EXTENSIONS)),
+            key=lambda p: os.path.basename(p).lower(),
+        )
+        self.index = self.files.index(path) if path in self.files else None
+        if self.index is None:
+            return
+
+        # nearest first, forward before backward
+        neighbours = []
+        for distance in range(1, self.radius + 1):
+            for offset in (distance, -distance):
+                if 0 <= self.index + offset < len(self.files):
+                    neighbours.append(self.files[self.index + offset])
+        self.prefetcher.prefetch(neighbours, owner=self)
+
+    def neighbour(self, offset):
+        """
+        Path of the image `offset` files from the current one, or None past either end.
+        """
+        if self.index is None or not 0 <= self.index + offset < len(self.files):
+            return None
+        return self.files[self.index + offset]
+
+    def readable_neighbour(self, offset):
+        """
+        Like neighbour(), but skips further in the same direction past files
+        that cannot be decoded (truncated, half-written or misnamed).
+        """
+        direction = 1 if offset > 0 else -1
+        path = self.neighbour(offset)
+        while path is not None and self.prefetcher.get(path).isNull():
+            offset += direction
+            path = self.neighbour(offset)
+        return path
+
+
+# name under which a window appears in session logs
+def _window_target(window):
+    return "map" if isinstance(window, InteractiveMapWindow) else "app"
+
+
+# image a load_image/step_image call will show, or None for other calls
+def _prefetch_target(window, name, args):
+    if name == "load_image":
+        path = args[-1]
+    elif name == "step_image" and isinstance(window, InteractiveMapWindow):
+        path = window.folder_browser.neighbour(args[0])
+    elif name == "step_image":
+        path = window.folder_browsers[args[0]].neighbour(args[1])
+    else:
+        return None
+    return os.path.abspath(path) if path else None
+
+
+class InteractionRecorder(QObject):
+    """
+    Logs mouse and wheel events reaching each ClickableLabel, text and
+    dropdown edits, and @recorded window actions to a gzip JSON-lines file.
+    Every record starts with the seconds elapsed since recording began. Each
+    record is sync-flushed, so a session that ends in a crash is still readable
+    up to its last event.
+
+    Records also carry the state of the background workers that affect their
+    latency: whether a loaded or stepped-to image was already prefetched, and
+    whether a map click found the lookup grid built.
+    """
+    FORMAT_VERSION = 2
+    # double-clicks reach ClickableLabel.mousePressEvent too, so they are logged as their own kind
+    MOUSE_EVENTS = {QEvent.MouseButtonPress: "press", QEvent.MouseButtonDblClick: "double",
+                    QEvent.MouseMove: "move", QEvent.MouseButtonRelease: "release"}
+
+    def __init__(self, path):
+        super().__init__()
+        self.file = gzip.open(path, "wb")
+        self.start = time.perf_counter()
+        self.depth = 0
+        self.widget_names = {}
+        self.windows = []
+        self._write({"format": "dtrec", "version": self.FORMAT_VERSION})
+
+    def start_recording(self, app_window):
+        global _active_recorder
+        _active_recorder = self
+        self.attach(app_window)
+        QApplication.instance().aboutToQuit.connect(self.stop)
+        atexit.register(self.stop)
+
+    def stop(self):
+        global _active_recorder
+        if _active_recorder is self:
+            _active_recorder = None
+        if not self.file.closed:
+            self.file.close()
+
+    def _write(self, record):
+        if self.file.closed:
+            return
+        self.file.write((json.dumps(record, separators=(",", ":")) + "\n").encode())
+        self.file.flush(zlib.Z_SYNC_FLUSH)
+
+    def log(self, *record):
+        self._write([round(time.perf_counter() - self.start, 6), *record])
+
+    def log_call(self, window, name, args):
+        path = _prefetch_target(window, name, args)
+        state = {"cached": window.prefetcher.is_cached(path)} if path else {}
+        self.log("call", _window_target(window), state, name, list(args))
+
+    def attach(self, window):
+        target = _window_target(window)
+        self.windows.append(window)
+        for name, widget in vars(window).items():
+            if isinstance(widget, ClickableLabel):
+                self.widget_names[widget] = (target, name)
+                widget.installEventFilter(self)
+            elif isinstance(widget, QLineEdit):
+                widget.textChanged.connect(lambda text, name=name: self.log("text", target, {}, name, text))
+            elif isinstance(widget, QComboBox):
+                widget.currentIndexChanged.connect(lambda index, name=name: self.log("index", target, {}, name, index))
+
+    def attach_new_windows(self, window):
+        map_window = getattr(window, "interactive_map_window", None)
+        if map_window is not None and not any(map_window is w for w in self.windows):
+            self.attach(map_window)
+
+    def eventFilter(self, obj, event):
+        kind = self.MOUSE_EVENTS.get(event.type())
+        if kind is not None and obj in self.widget_names:
+            target, name = self.widget_names[obj]
+            state = {}
+            window = obj.parent_window
+            if (kind in ("press", "double") and isinstance(window, InteractiveMapWindow)
+                    and window.distortion_model is not None):
+                state["grid"] = window.lookup_grid is not None
+            self.log("mouse", target, state, name, kind, event.x(), event.y(),
+                     int(event.button()), int(event.buttons()), int(event.modifiers()))
+        elif event.type() == QEvent.Wheel and obj in self.widget_names:
+            target, name = self.widget_names[obj]
+            self.log("wheel", target, {}, name, event.pos().x(), event.pos().y(),
+                     event.angleDelta().y(), int(event.buttons()), int(event.modifiers()))
+        return False
+
+
+def latency_percentiles(latencies, percentiles=(50, 90, 99)):
+    """
+    Summarize a list of latencies in seconds as {"count", "p50", ..., "max"} in milliseconds.
+    """
+    values = np.asarray(latencies) * 1e3
+    summary = {"count": len(values)}
+    for p in percentiles:
+        summary[f"p{p}"] = float(np.percentile(values, p))
+    summary["max"] = float(values.max())
+    return summary
+
+
+def read_session(path):
+    """
+    Yield the header and records of a session log. A log cut short by a crash
+    ends at its last complete record instead of raising.
+    """
+    with gzip.open(path, "rt") as f:
+        try:
+            for line in f:
+                if not line.endswith("\n"):
+                    return
+                yield json.loads(line)
+        except EOFError:
+            return
+
+
+def replay_session(path):
+    """
+    Replay a recorded session as fast as possible and return the latency of
+    each record, in seconds, grouped by event kind or action name. Each
+    latency covers delivering the record and processing the repaints it
+    queues. Before each record, replay waits (untimed) until the prefetch
+    cache and lookup grid are in their recorded state, and tags the keys of
+    events that depend on them with that state. Dialogs are replaced by
+    collecting messages, so this runs headless; set QT_QPA_PLATFORM=offscreen
+    before the QApplication exists.
+    """
+    app = QApplication.instance() or QApplication(sys.argv[:1])
+    windows = {}
+    messages = []
+    latencies = {}
+
+    def adopt(target, window):
+        window.show_message = messages.append
+        window.show()
+        windows[target] = window
+
+    adopt("app", ImageTrackingApp())
+    QApplication.processEvents()
+
+    records = read_session(path)
+    header = next(records, None)
+    if not isinstance(header, dict) or header.get("format") != "dtrec":
+        raise ValueError(f"{path} is not a recorded session")
+    if header.get("version") != InteractionRecorder.FORMAT_VERSION:
+        raise ValueError(f"{path} is a version {header.get('version')} session; "
+                         f"this replayer reads version {InteractionRecorder.FORMAT_VERSION}")
+
+    def wait_for(condition, timeout=30.0):
+        deadline = time.perf_counter() + timeout
+        while not condition():
+            if time.perf_counter() > deadline:
+                return False
+            QApplication.processEvents()
+            time.sleep(0.001)
+        return True
+
+    for _, kind, target, state, *rest in records:
+        window = windows[target]
+
+        if kind == "mouse":
+            widget_name, event_kind, x, y, button, buttons, modifiers = rest
+            event_type = {v: k for k, v in InteractionRecorder.MOUSE_EVENTS.items()}[event_kind]
+            event = QMouseEvent(event_type, QPointF(x, y), Qt.MouseButton(button),
+                                Qt.MouseButtons(buttons), Qt.KeyboardModifiers(modifiers))
+            key = event_kind
+        elif kind == "wheel":
+            widget_name, x, y, angle, buttons, modifiers = rest
+            widget = getattr(window, widget_name)
+            event = QWheelEvent(QPointF(x, y), QPointF(widget.mapToGlobal(QPoint(x, y))), QPoint(0, 0),
+                                QPoint(0, angle), Qt.MouseButtons(buttons), Qt.KeyboardModifiers(modifiers),
+                                Qt.NoScrollPhase, False)
+            key = "wheel"
+        else:
+            key = f"call:{rest[0]}" if kind == "call" else kind
+
+        # Bring the background workers to the recorded state (untimed), and report
+        # events that depend on them separately
+        reproduced = True
+        if "cached" in state:
+            target_path = _prefetch_target(window, rest[0], rest[1])
+            if state["cached"]:
+                reproduced = wait_for(lambda: window.prefetcher.is_cached(target_path))
+            elif target_path:
+                window.prefetcher.discard(target_path)
+            key += " [cache hit]" if state["cached"] else " [decode]"
+        if "grid" in state:
+            if state["grid"]:
+                reproduced = wait_for(lambda: window.lookup_grid is not None)
+            else:
+                reproduced = window.lookup_grid is None
+            key += " [grid]" if state["grid"] else " [direct model]"
+        if not reproduced:
+            key += " (state differs)"
+
+        start = time.perf_counter()
+        if kind in ("mouse", "wheel"):
+            QApplication.sendEvent(getattr(window, widget_name), event)
+        elif kind == "text":
+            getattr(window, rest[0]).setText(rest[1])
+        elif kind == "index":
+            getattr(window, rest[0]).setCurrentIndex(rest[1])
+        elif kind == "call":
+            getattr(window, rest[0])(*rest[1])
+        QApplication.processEvents()
+        latencies.setdefault(key, []).append(time.perf_counter() - start)
+
+        map_window = getattr(windows["app"], "interactive_map_window", None)
+        if map_window is not None and windows.get("map") is not map_window:
+            adopt("map", map_window)
+
+    return latencies
+
+
+def print_latency_report(latencies):
+    print(f"{'event':<40}{'count':>8}{'p50 ms':>10}{'p90 ms':>10}{'p99 ms':>10}{'max ms':>10}")
+    for key in sorted(latencies):
+        summary = latency_percentiles(latencies[key])
+        print(f"{key:<40}{summary['count']:>8}{summary['p50']:>10.3f}{summary['p90']:>10.3f}"
+              f"{summary['p99']:>10.3f}{summary['max']:>10.3f}")
 
 
 def main():
-    app = QApplication(sys.argv)
+    parser = argparse.ArgumentParser(description="Diamond Image Tracking")
+    parser.add_argument("--record", metavar="SESSION", help="record the interaction session to this file")
+    parser.add_argument("--replay", metavar="SESSION", help="replay a recorded session headless and report latencies")
+    args, qt_args = parser.parse_known_args()
+
+    if args.replay:
+        os.environ["QT_QPA_PLATFORM"] = "offscreen"
+        app = QApplication(sys.argv[:1] + qt_args)
+        print_latency_report(replay_session(args.replay))
+        return
+
+    app = QApplication(sys.argv[:1] + qt_args)
     ex = ImageTrackingApp()
+    recorder = None
+    if args.record:
+        recorder = InteractionRecorder(args.record)
+        recorder.start_recording(ex)
     ex.show()
-    sys.exit(app.exec_())
+    status = app.exec_()
+    if recorder is not None:
+        recorder.stop()
+    sys.exit(status)
 
 
 if __name__ == '__main__':